@@ -1,193 +1,210 @@
+import asyncio
+import gzip
 import hashlib
-import json
+import math
+import struct
+import threading
 import time
-from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from flask import Flask, jsonify, request, render_template, Response
+from flask.json.provider import JSONProvider
 from uuid import uuid4
 from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
+from ecdsa.der import UnexpectedDER
+from ecdsa.ellipticcurve import MalformedPointError
+from ecdsa.keys import BadDigestError
+from ecdsa.util import sigdecode_der
 import queue
+import orjson
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from blockchain_core import Block, Blockchain, json_dumps, POW_WORKERS, start_pow_pool
 
 #設定
-MINING_REWARD_INITIAL = 50
-MAX_COIN_SUPPLY = 21000000
-DIFFICULTY = 3
+SSE_COALESCE_SECONDS = 0.02 # この間に届いた通知はまとめて1回だけ配信する
+CHAIN_GZIP_MIN_BYTES = 64 * 1024 # /chain の本体がこれ以上なら gzip 済みのものを返す
+SSE_HEARTBEAT_SECONDS = 15 # この間通知がなければコメント行を送り、切断検知とプロキシのタイムアウトを防ぐ
+CHAIN_STREAM_MIN_BLOCKS = 1000 # キャッシュがないとき、これ以上のチェーンは丸ごと作らずブロックごとに送る
+# リクエスト本体の上限。/nodes/resolve にはウォレットが手元のチェーンを丸ごと送ってくる
+# (hypercorn の WSGI ミドルウェアの既定は 64KiB で、150ブロック前後で超えてしまう)
+MAX_REQUEST_BODY_BYTES = 64 * 1024 * 1024
+
+class OrjsonProvider(JSONProvider):
+    """
+    jsonify / request.get_json を orjson で処理する
+    """
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # str を経由せず bytes のまま返す
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps(obj), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-#SSE用
-message_queue = queue.Queue()
-
-#ブロックチェーンクラス
-class Blockchain:
-    def __init__(self):
-        self.chain = []
-        self.current_transactions = []
-        #ジェネシスブロック生成
-        self.new_block(previous_hash='0', proof=0)
-
-    def new_block(self, proof, previous_hash=None):
-        """
-        ブロックチェーンに新しいブロックを作る
-        """
-        # 現在の総発行枚数を計算
-        issued_amount = 0
-        for b in self.chain:
-            for tx in b['transactions']:
-                if tx['sender'] == '0':
-                    issued_amount += tx['amount']
-        
-        # 報酬の計算 (半減期ロジック)
-        reward = MINING_REWARD_INITIAL
-        current_threshold = MAX_COIN_SUPPLY / 2
-        
-        # 簡易的な減衰計算
-        temp_issued = issued_amount
-        while temp_issued >= current_threshold:
-            reward /= 2
-            current_threshold += (MAX_COIN_SUPPLY - current_threshold) / 2
-            if reward < 0.00000001: break
-
-        # 前のブロックのハッシュを決定
-        if previous_hash:
-            ph = previous_hash
-        elif self.chain:
-            ph = self.chain[-1]['hash']
-        else:
-            ph = '0'
-
-        block = {
-            'index': len(self.chain), # 0スタート
-            'timestamp': datetime.now(timezone(timedelta(hours=9))).isoformat(), # JST
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': ph,
-            'reward_at_block': reward
-        }
-
-        # 自身のハッシュを計算してブロックに含める
-        block['hash'] = self.hash(block)
-
-        self.current_transactions = []
-        self.chain.append(block)
-        return block
-
-    def new_transaction(self, sender, recipient, amount, signature=None):
-        """
-        新しいトランザクションをリストに加える
-        """
-        transaction = {
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-            'signature': signature,
-            'timestamp': datetime.now(timezone(timedelta(hours=9))).isoformat()
-        }
-        self.current_transactions.append(transaction)
-        # 次のブロックのインデックスを返す
-        return len(self.chain)
-
-    @staticmethod
-    def hash(block):
-        """
-        ブロックのSHA-256ハッシュを作る
-        注意: ブロック辞書の中に既に 'hash' キーがある場合は除外して計算する
-        """
-        block_copy = block.copy()
-        if 'hash' in block_copy:
-            del block_copy['hash']
-            
-        block_string = json.dumps(block_copy, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
-
-    @property
-    def last_block(self):
-        return self.chain[-1]
-
-    def proof_of_work(self, last_proof):
-        """
-        シンプルなPoW: hash(pp')の先頭が000...となるp'を探す
-        """
-        proof = 0
-        while self.valid_proof(last_proof, proof) is False:
-            proof += 1
-        return proof
-
-    @staticmethod
-    def valid_proof(last_proof, proof):
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:DIFFICULTY] == "0" * DIFFICULTY
-
-    def valid_chain(self, chain):
-        """
-        チェーンの整合性を確認
-        """
-        last_block = chain[0]
-        current_index = 1
-
-        # ジェネシスブロックのチェック (簡易)
-        if last_block['index'] != 0 or last_block['previous_hash'] != '0':
-            return False
-
-        while current_index < len(chain):
-            block = chain[current_index]
-            
-            # ブロックの previous_hash が前のブロックの hash と一致するか
-            if block['previous_hash'] != last_block['hash']:
-                return False
-
-            # 前のブロックのハッシュ値自体が正しいか再計算チェック（改竄検知）
-            if self.hash(last_block) != last_block['hash']:
-                return False
-
-            # PoWのチェック
-            if not self.valid_proof(last_block['proof'], block['proof']):
-                return False
-
-            last_block = block
-            current_index += 1
-
-        return True
-
-    def calculate_balance(self, address):
-        balance = 0
-        for block in self.chain:
-            for tx in block['transactions']:
-                if tx['recipient'] == address:
-                    balance += tx['amount']
-                if tx['sender'] == address:
-                    balance -= tx['amount']
-        
-        # 未承認トランザクションも考慮
-        for tx in self.current_transactions:
-            if tx['sender'] == address:
-                balance -= tx['amount']
-                
-        return balance
+# チェーン・トランザクションプール・残高インデックスを触るときはこのロックを取る
+blockchain_lock = threading.Lock()
+
+#SSE用: 通知のたびに番号を1つ進め、各クライアントは最後に送った番号より先へ進むのを待つ
+# クライアントごとのキューは持たない。触るのはイベントループのスレッドだけ
+event_cv = asyncio.Condition()
+event_counter = 0
+last_events = ()
+_sse_loop = None
 
 # ブロックチェーンのインスタンス化
 blockchain = Blockchain()
 
+# --- 署名検証 ---
+@lru_cache(maxsize=4096)
+def load_verifying_key(public_key):
+    """
+    hexの公開鍵をパースする。同じ送金者の鍵は2回目以降パースし直さない
+    """
+    return VerifyingKey.from_string(bytes.fromhex(public_key), curve=SECP256k1)
+
+def verify_signature(sender, recipient, amount, signature):
+    """
+    ウォレットの署名を検証する
+    署名対象は SHA256(送信者 + 受信者 + 金額) のダイジェスト (index.html の sendTransaction と同じ)
+    """
+    digest = hashlib.sha256(f'{sender}{recipient}{amount}'.encode()).digest()
+    try:
+        vk = load_verifying_key(sender)
+        return vk.verify_digest(bytes.fromhex(signature), digest, sigdecode=sigdecode_der)
+    except (ValueError, TypeError, MalformedPointError, UnexpectedDER, BadDigestError, BadSignatureError):
+        return False
+
 # --- ルート定義 ---
 
+def chain_body(chain_json, **fields):
+    """
+    キャッシュ済みのチェーンJSONを 'chain' として埋め込んだレスポンス本体を作る
+    """
+    body = orjson.dumps(fields)[:-1]
+    if fields:
+        body += b','
+    body += b'"chain":' + chain_json + b'}'
+    return body
+
+def chain_response(chain_json, status=200, **fields):
+    return Response(chain_body(chain_json, **fields), status=status, mimetype='application/json')
+
+# /chain の gzip 済み本体: (元にしたチェーンJSON, 圧縮後のbytes)
+# チェーンJSONのキャッシュが作り直されたら別オブジェクトになるので、同一性で鮮度を判定する
+_chain_gzip = (None, None)
+
+def gzip_chain_response(chain_json, length):
+    global _chain_gzip
+    source, compressed = _chain_gzip
+    if source is not chain_json:
+        compressed = gzip.compress(chain_body(chain_json, length=length), compresslevel=6)
+        _chain_gzip = (chain_json, compressed)
+    response = Response(compressed, mimetype='application/json')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def stream_chain(blocks):
+    """
+    /chain と同じ形のJSONを、ブロック1つずつ書き出しながら送る
+    送り終えたら同じ内容をチェーンJSONのキャッシュに入れ、次からはキャッシュを返す
+    """
+    parts = []
+    yield b'{"length":%d,"chain":[' % len(blocks)
+    for i, block in enumerate(blocks):
+        part = json_dumps(block)
+        parts.append(part)
+        yield (b',' if i else b'') + part
+    yield b']}'
+    with blockchain_lock:
+        blockchain.fill_chain_json(b'[' + b','.join(parts) + b']', blocks[-1])
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+TRANSACTION_FIELDS = ['sender', 'recipient', 'amount', 'signature']
+
+def invalid_fields(values):
+    """
+    プールに入れる前に各フィールドの型と金額を確かめる。問題があればそのメッセージを返す
+    """
+    if not isinstance(values['sender'], str) or not isinstance(values['recipient'], str):
+        return '送信者・受信者が不正です'
+    try:
+        amount = float(values['amount'])
+    except (TypeError, ValueError):
+        return '金額が不正です'
+    if not math.isfinite(amount):
+        return '金額が不正です'
+    return None
+
+def signature_ok(values):
+    # 報酬 (sender == '0') は署名を持たない
+    return values['sender'] == '0' or verify_signature(
+        values['sender'], values['recipient'], values['amount'], values['signature'])
+
+def add_transaction(values):
+    """
+    残高を確認してプールに追加する。blockchain_lock を取った状態で呼ぶこと
+    """
+    if values['sender'] != '0':
+        current_balance = blockchain.calculate_balance(values['sender'])
+        if current_balance < float(values['amount']):
+            return {'message': '残高不足です', 'status': 'fail'}, 400
+
+    index = blockchain.new_transaction(values['sender'], values['recipient'], float(values['amount']), values['signature'])
+    return {'message': f'トランザクションはブロック #{index} に追加されます', 'status': 'success'}, 201
+
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
     values = request.get_json()
-    required = ['sender', 'recipient', 'amount', 'signature']
-    if not all(k in values for k in required):
+    if not all(k in values for k in TRANSACTION_FIELDS):
         return 'Missing values', 400
 
-    if values['sender'] != '0':
-        current_balance = blockchain.calculate_balance(values['sender'])
-        if current_balance < float(values['amount']):
-            return jsonify({'message': '残高不足です', 'status': 'fail'}), 400
+    error = invalid_fields(values)
+    if error:
+        return jsonify({'message': error, 'status': 'fail'}), 400
 
-    index = blockchain.new_transaction(values['sender'], values['recipient'], float(values['amount']), values['signature'])
-    return jsonify({'message': f'トランザクションはブロック #{index} に追加されます', 'status': 'success'}), 201
+    # 署名検証は重いのでロックの外で行う
+    if not signature_ok(values):
+        return jsonify({'message': '署名が不正です', 'status': 'fail'}), 400
+
+    # 残高確認と追加の間に他の送金が割り込まないようにまとめてロックする
+    with blockchain_lock:
+        result, status = add_transaction(values)
+    return jsonify(result), status
+
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions():
+    """
+    {"transactions": [...]} をまとめて受け付ける。結果は1件ずつ返す
+    """
+    values = request.get_json()
+    txs = values.get('transactions')
+    if not isinstance(txs, list) or not all(isinstance(tx, dict) for tx in txs):
+        return 'Missing values', 400
+
+    # ロックの中で例外が出て途中まで追加されることがないよう、形式の確認もここで済ませる
+    checked = []
+    for tx in txs:
+        error = 'Missing values' if not all(k in tx for k in TRANSACTION_FIELDS) else invalid_fields(tx)
+        if error:
+            checked.append(({'message': error, 'status': 'fail'}, 400))
+        elif not signature_ok(tx):
+            checked.append(({'message': '署名が不正です', 'status': 'fail'}, 400))
+        else:
+            checked.append(None)
+
+    # 署名の通ったものだけ、1回のロックでまとめて追加する
+    with blockchain_lock:
+        results = [check or add_transaction(tx) for tx, check in zip(txs, checked)]
+    return jsonify({'results': [result for result, status in results]}), 200
 
 @app.route('/mine', methods=['POST'])
 def mine():
@@ -196,48 +213,55 @@ def mine():
 
     if not miner_address:
         return 'Miner address missing', 400
+    # 報酬の受取人になるので、PoWを始める前に型を確かめる
+    if not isinstance(miner_address, str):
+        return 'Invalid miner address', 400
+
+    # PoWはロックの外で行い、その間も残高照会や送金を受け付ける
+    while True:
+        with blockchain_lock:
+            last_block = blockchain.last_block
+        last_proof = last_block.proof
+
+        proof = blockchain.proof_of_work(last_proof)
+
+        with blockchain_lock:
+            if blockchain.last_block is not last_block:
+                # 探索中に他のマイニングや同期でチェーンが進んだのでやり直す
+                continue
+
+            # 報酬トランザクション
+            blockchain.new_transaction(
+                sender="0",
+                recipient=miner_address,
+                amount=blockchain.current_reward()
+            )
+
+            # ブロック生成
+            block = blockchain.new_block(proof)
+            break
 
-    last_block = blockchain.last_block
-    last_proof = last_block['proof']
-    
-    proof = blockchain.proof_of_work(last_proof)
-
-    # 報酬計算（簡易）
-    reward = MINING_REWARD_INITIAL
-    # 現在の発行済量から計算
-    issued = 0
-    for b in blockchain.chain:
-        for tx in b['transactions']:
-            if tx['sender'] == '0':
-                issued += tx['amount']
-    
-    current_threshold = MAX_COIN_SUPPLY / 2
-    while issued >= current_threshold:
-        reward /= 2
-        current_threshold += (MAX_COIN_SUPPLY - current_threshold) / 2
-        if reward < 0.00000001: break
-    
-    # 報酬トランザクション
-    blockchain.new_transaction(
-        sender="0",
-        recipient=miner_address,
-        amount=reward
-    )
-
-    # ブロック生成
-    block = blockchain.new_block(proof)
-
-    message_queue.put("new_block")
+    broadcast("new_block")
 
     return jsonify({'message': 'マイニング成功', 'block': block}), 200
 
 @app.route('/chain', methods=['GET'])
 def full_chain():
-    response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain),
-    }
-    return jsonify(response), 200
+    with blockchain_lock:
+        chain_json = blockchain.cached_chain_json()
+        if chain_json is None and len(blockchain.chain) >= CHAIN_STREAM_MIN_BLOCKS:
+            # 追加済みのブロックは書き換わらないので、並びだけ控えてロックの外で送る
+            blocks = list(blockchain.chain)
+        else:
+            blocks = None
+            chain_json = blockchain.chain_json()
+        length = len(blockchain.chain)
+    if blocks is not None:
+        return Response(stream_chain(blocks), mimetype='application/json')
+    # 大きいチェーンは圧縮結果を次の変更まで使い回す
+    if len(chain_json) >= CHAIN_GZIP_MIN_BYTES and request.accept_encodings['gzip']:
+        return gzip_chain_response(chain_json, length)
+    return chain_response(chain_json, length=length)
 
 @app.route('/nodes/resolve', methods=['POST'])
 def consensus():
@@ -245,37 +269,161 @@ def consensus():
     client_chain = values.get('chain')
 
     if not client_chain:
-        return jsonify({'message': 'No chain provided', 'chain': blockchain.chain}), 400
-
-    if len(client_chain) > len(blockchain.chain):
-        # クライアントチェーンを採用
-        # 本来は検証が必要だがデモ用に受け入れる
-        blockchain.chain = client_chain
-        blockchain.current_transactions = [] # プールをリセット
-        message = 'サーバーのチェーンが更新されました'
-        new_chain = client_chain
-    else:
-        message = 'サーバーのチェーンが維持されました'
-        new_chain = blockchain.chain
+        with blockchain_lock:
+            chain_json = blockchain.chain_json()
+        return chain_response(chain_json, 400, message='No chain provided')
+
+    with blockchain_lock:
+        longer = len(client_chain) > len(blockchain.chain)
+
+    if longer:
+        # ハッシュの再計算を含む検証は重いのでロックの外で行う
+        try:
+            blocks = [Block.from_dict(b) for b in client_chain]
+            valid = blockchain.valid_chain(blocks)
+        except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+            # 形式がおかしいチェーンも不正として扱う
+            valid = False
+
+        if not valid:
+            with blockchain_lock:
+                chain_json = blockchain.chain_json()
+            return chain_response(chain_json, 400, message='クライアントのチェーンは不正です')
+
+    with blockchain_lock:
+        # 検証中に自分のチェーンが伸びていなければクライアントチェーンを採用
+        if longer and len(blocks) > len(blockchain.chain):
+            blockchain.replace_chain(blocks)
+            message = 'サーバーのチェーンが更新されました'
+        else:
+            message = 'サーバーのチェーンが維持されました'
+        chain_json = blockchain.chain_json()
 
-    return jsonify({'message': message, 'chain': new_chain}), 200
+    return chain_response(chain_json, message=message)
 
 @app.route('/balance', methods=['POST'])
 def get_balance():
     values = request.get_json()
     address = values.get('address')
-    balance = blockchain.calculate_balance(address)
+    # 残高インデックスの辞書を引くので、文字列以外 (リストなど) はここで弾く
+    if not isinstance(address, str):
+        return 'Invalid address', 400
+    with blockchain_lock:
+        balance = blockchain.calculate_balance(address)
     return jsonify({'balance': balance}), 200
 
 # --- SSE ---
-def event_stream():
-    while True:
-        msg = message_queue.get()
-        yield f"data: {msg}\n\n"
+# ルートからの通知はここに積むだけにして、配信は専用スレッドが行う
+dirty_events = queue.SimpleQueue()
 
-@app.route('/events')
-def sse():
-    return Response(event_stream(), mimetype="text/event-stream")
+def broadcast(msg):
+    """
+    全クライアントへの通知を予約する（すぐに戻る）
+    """
+    dirty_events.put(msg)
 
+def broadcaster():
+    while True:
+        msgs = [dirty_events.get()]
+        # 短い時間待って、その間に届いた通知もまとめる
+        time.sleep(SSE_COALESCE_SECONDS)
+        while True:
+            try:
+                msgs.append(dirty_events.get_nowait())
+            except queue.Empty:
+                break
+
+        # 同じ通知は1回だけ送る。カウンタはイベントループ側で進める
+        loop = _sse_loop
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(_publish(tuple(dict.fromkeys(msgs))), loop)
+
+async def _publish(msgs):
+    global event_counter, last_events
+    async with event_cv:
+        event_counter += 1
+        last_events = msgs
+        event_cv.notify_all()
+
+async def _next_events(seen):
+    """
+    event_counter が seen より進むまで待ち、(新しい番号, 通知) を返す
+    間に複数回進んでいても、通知は「チェーンが変わった」合図なので最新のものだけで足りる
+    """
+    async with event_cv:
+        await event_cv.wait_for(lambda: event_counter > seen)
+        return event_counter, last_events
+
+broadcaster_thread = threading.Thread(target=broadcaster, daemon=True)
+broadcaster_thread.start()
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def sse(scope, receive, send):
+    """
+    /events: 接続ごとにスレッドを使わず、イベントループ上で待つ
+    """
+    global _sse_loop
+    _sse_loop = asyncio.get_running_loop()
+    seen = event_counter
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    waiter = None
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+        })
+        while True:
+            if waiter is None:
+                waiter = asyncio.ensure_future(_next_events(seen))
+            await asyncio.wait((waiter, disconnected), timeout=SSE_HEARTBEAT_SECONDS,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                break
+            if not waiter.done():
+                # 通知がないまま時間が過ぎたのでキープアライブだけ送る
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            seen, msgs = waiter.result()
+            waiter = None
+            for msg in msgs:
+                await send({'type': 'http.response.body', 'body': f"data: {msg}\n\n".encode(), 'more_body': True})
+    finally:
+        if waiter is not None:
+            waiter.cancel()
+        disconnected.cancel()
+
+# --- ASGI ---
+# JSONのルートは従来どおり Flask をスレッドプールで動かし、SSE だけ非同期で処理する
+flask_asgi = AsyncioWSGIMiddleware(app, max_body_size=MAX_REQUEST_BODY_BYTES)
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == '/events':
+        await sse(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # 最初のマイニングを待たせないよう、リクエストを受ける前にワーカーを起動しておく
+                # (python app.py でも hypercorn app:asgi_app でもここを通る)
+                if POW_WORKERS > 1:
+                    start_pow_pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    else:
+        await flask_asgi(scope, receive, send)
+
+# チェーン・残高・SSEの購読状態はすべてこのプロセスのメモリ上にあるので、必ず1プロセスで動かす
+# (python app.py か、hypercorn -w 1 app:asgi_app)。/events は接続ごとにスレッドを占有しない
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = ['0.0.0.0:5000']
+    asyncio.run(serve(asgi_app, config))
@@ -0,0 +1,517 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import orjson
+
+#設定
+MINING_REWARD_INITIAL = 50
+MAX_COIN_SUPPLY = 21000000
+# 難易度はハッシュ先頭の0ビット数。初期値は従来の「16進で先頭000」と同じ12ビット
+DIFFICULTY_BITS = 12
+MIN_DIFFICULTY_BITS = 8
+MAX_DIFFICULTY_BITS = 32
+TARGET_BLOCK_SECONDS = 10 # 目標のブロック間隔
+RETARGET_INTERVAL = 8 # このブロック数ごとに直近の間隔から難易度を見直す
+MAX_RETARGET_STEP_BITS = 2 # 1回の見直しで動かす上限 (作業量で4倍まで)
+# 報酬が 0.00000001 を下回った時点で半減を打ち切る
+MAX_HALVINGS = next(n for n in range(1, 64) if MINING_REWARD_INITIAL / (1 << n) < 0.00000001)
+POW_BATCH_SIZE = 1000000 # find_nonce 1回あたりに試すnonce数
+POW_WORKERS = os.cpu_count() or 1 # 並列マイニングのプロセス数
+POW_WORKER_CHUNK = 20000 # 並列時に1ワーカーへ渡すnonce範囲の大きさ
+POW_PARALLEL_MIN_BITS = 20 # これ未満はプロセス間通信の方が高くつくので単独で探す
+
+def pow_target(bits):
+    """
+    先頭 bits ビットが0 ⇔ ダイジェスト(256bitの整数)が 2**(256-bits) 未満
+    同じ長さの bytes 同士の大小比較は整数の比較と一致するので、bytes で持っておく
+    """
+    return (1 << (256 - bits)).to_bytes(32, 'big')
+
+# 取り得る難易度ごとの目標値。検証のたびに作り直さない
+POW_TARGETS = {bits: pow_target(bits) for bits in range(MIN_DIFFICULTY_BITS, MAX_DIFFICULTY_BITS + 1)}
+
+def find_nonce(prefix, suffix, bits, start_nonce, batch):
+    """
+    hash(prefix + nonce + suffix) の先頭 bits ビットが0になるnonceを
+    start_nonce から batch 個分まとめて探す。見つからなければ None
+    """
+    target = pow_target(bits)
+    # 変化しない prefix は一度だけ投入し、中間状態(midstate)をコピーして使い回す
+    # ループ自体は Python のままにしている: 1回あたりのコストは hashlib オブジェクトの生成が大半で、
+    # map/compress だけで組んだ版はこのループより遅かった。CPUを使い切るのは parallel_find_nonce の役目
+    base = hashlib.sha256(prefix)
+    for nonce in range(start_nonce, start_nonce + batch):
+        h = base.copy()
+        h.update(str(nonce).encode() + suffix)
+        if h.digest() < target:
+            return nonce
+    return None
+
+# --- 並列マイニング ---
+_pow_pool = None
+_pow_found = None
+_pow_lock = threading.Lock()
+
+def _init_pow_worker(found):
+    global _pow_found
+    _pow_found = found
+
+def _search_stride(args):
+    """
+    ワーカー側の探索。worker_id 番目から n_workers 個おきのチャンクを担当するので
+    ワーカー同士で同じnonceを重複して試すことはない
+    """
+    prefix, suffix, bits, worker_id, n_workers = args
+    chunk = worker_id
+    while not _pow_found.is_set():
+        nonce = find_nonce(prefix, suffix, bits, chunk * POW_WORKER_CHUNK, POW_WORKER_CHUNK)
+        if nonce is not None:
+            _pow_found.set()
+            return nonce
+        chunk += n_workers
+    return None
+
+def _ensure_pow_pool():
+    # _pow_lock を取った状態で呼ぶ
+    global _pow_pool, _pow_found
+    if _pow_pool is None:
+        _pow_found = multiprocessing.Event()
+        _pow_pool = multiprocessing.Pool(
+            POW_WORKERS, initializer=_init_pow_worker, initargs=(_pow_found,))
+
+def start_pow_pool():
+    """
+    並列マイニング用のワーカープロセスを先に起動しておく (起動済みなら何もしない)
+    ワーカーは探索の合間も残しておくので、/mine のたびにプロセスを作り直さない
+    """
+    with _pow_lock:
+        _ensure_pow_pool()
+
+def parallel_find_nonce(prefix, suffix, bits):
+    """
+    全コアでnonceを分担して探し、最初に見つかったものを返す
+    """
+    with _pow_lock:
+        _ensure_pow_pool()
+        _pow_found.clear()
+        tasks = [(prefix, suffix, bits, wid, POW_WORKERS) for wid in range(POW_WORKERS)]
+        winner = None
+        # 全ワーカーの終了を待ってから返す（次の探索に取り残しを持ち込まない）
+        for nonce in _pow_pool.imap_unordered(_search_stride, tasks):
+            if nonce is not None and winner is None:
+                winner = nonce
+                _pow_found.set()
+        return winner
+
+# --- 時刻 ---
+# タイムスタンプは内部ではUNIX時間のマイクロ秒(int)で持ち、JSONに書き出すときだけ ISO 形式(JST)にする
+# マイクロ秒単位なら ISO 文字列との間を往復しても値が変わらない
+JST = timezone(timedelta(hours=9))
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+def now_us():
+    return time.time_ns() // 1000
+
+def format_timestamp(us):
+    return (_EPOCH + us * _MICROSECOND).astimezone(JST).isoformat()
+
+def parse_timestamp(text):
+    """
+    ISO 形式の文字列をマイクロ秒にする。format_timestamp で書き戻せない値は ValueError にする
+    """
+    # 9999-12-31T23:59:59+00:00 などは読めても JST に直すと範囲外になり、/chain を返せなくなる
+    try:
+        us = (datetime.fromisoformat(text) - _EPOCH) // _MICROSECOND
+        format_timestamp(us)
+    except OverflowError:
+        raise ValueError(f'timestamp out of range: {text}')
+    return us
+
+# ブロックハッシュ用のバイナリ形式 (リトルエンディアン)
+# 先頭: index, proof, reward_at_block, difficulty, トランザクション数, timestamp
+_BLOCK_HEAD = struct.Struct('<QQdIIq')
+# トランザクションの amount, timestamp
+_TX_NUMS = struct.Struct('<dq')
+_STR_LEN = struct.Struct('<I')
+
+def _put_str(buf, s):
+    """
+    文字列を長さ付きの UTF-8 として buf に追加する
+    """
+    data = s.encode()
+    buf += _STR_LEN.pack(len(data))
+    buf += data
+
+@dataclass(slots=True)
+class Transaction:
+    """
+    トランザクション。timestamp はマイクロ秒(int)
+    """
+    sender: str
+    recipient: str
+    amount: float
+    signature: str
+    timestamp: int
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            sys.intern(data['sender']),
+            sys.intern(data['recipient']),
+            data['amount'],
+            data.get('signature'),
+            parse_timestamp(data['timestamp']),
+        )
+
+    def to_dict(self):
+        return {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount,
+            'signature': self.signature,
+            'timestamp': format_timestamp(self.timestamp),
+        }
+
+@dataclass(slots=True)
+class Block:
+    index: int
+    timestamp: int # マイクロ秒
+    transactions: list
+    proof: int
+    previous_hash: str
+    reward_at_block: float
+    difficulty: int = DIFFICULTY_BITS # このブロックのPoWが満たす先頭0ビット数
+    hash: str = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['index'],
+            parse_timestamp(data['timestamp']),
+            [Transaction.from_dict(tx) for tx in data['transactions']],
+            data['proof'],
+            data['previous_hash'],
+            data['reward_at_block'],
+            data.get('difficulty', DIFFICULTY_BITS),
+            data['hash'],
+        )
+
+    def to_dict(self):
+        """
+        JSON用の dict。トランザクションは default 経由で to_dict される
+        """
+        return {
+            'index': self.index,
+            'timestamp': format_timestamp(self.timestamp),
+            'transactions': self.transactions,
+            'proof': self.proof,
+            'previous_hash': self.previous_hash,
+            'reward_at_block': self.reward_at_block,
+            'difficulty': self.difficulty,
+            'hash': self.hash,
+        }
+
+    def packed(self):
+        """
+        ハッシュ計算の対象になるフィールド ('hash' 以外) を固定のバイナリ形式に並べる
+        数値は整数も小数も同じバイト列になるので、JSONで 50.0 が 50 になってもハッシュは変わらない
+        """
+        buf = bytearray(_BLOCK_HEAD.pack(
+            self.index, self.proof, self.reward_at_block, self.difficulty,
+            len(self.transactions), self.timestamp))
+        _put_str(buf, self.previous_hash)
+        for tx in self.transactions:
+            _put_str(buf, tx.sender)
+            _put_str(buf, tx.recipient)
+            buf += _TX_NUMS.pack(tx.amount, tx.timestamp)
+            # 報酬トランザクションは署名を持たない (None と空文字を区別する)
+            if tx.signature is None:
+                buf += b'\0'
+            else:
+                buf += b'\1'
+                _put_str(buf, tx.signature)
+        return buf
+
+    @property
+    def time(self):
+        return self.timestamp / 1e6
+
+def _json_default(obj):
+    if isinstance(obj, (Block, Transaction)):
+        return obj.to_dict()
+    raise TypeError
+
+def json_dumps(obj):
+    """
+    ブロック・トランザクションを含むオブジェクトを JSON(bytes) にする
+    dataclass はそのまま書き出さず to_dict を通し、timestamp を ISO 形式にする
+    """
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATACLASS)
+
+def retarget(bits, block_times):
+    """
+    直近 RETARGET_INTERVAL 区間の平均ブロック間隔から次の難易度を決める
+    作業量 D' = D * 目標間隔 / 実際の間隔 をビット数に直したもの
+    """
+    avg = (block_times[-1] - block_times[0]) / (len(block_times) - 1)
+    if avg <= 0:
+        step = MAX_RETARGET_STEP_BITS
+    else:
+        step = round(math.log2(TARGET_BLOCK_SECONDS / avg))
+    step = max(-MAX_RETARGET_STEP_BITS, min(MAX_RETARGET_STEP_BITS, step))
+    return max(MIN_DIFFICULTY_BITS, min(MAX_DIFFICULTY_BITS, bits + step))
+
+class DifficultyTracker:
+    """
+    チェーンの先頭から順にブロックを渡すと、次のブロックの難易度を追跡する
+    """
+    def __init__(self):
+        self.bits = DIFFICULTY_BITS
+        self.block_times = deque(maxlen=RETARGET_INTERVAL + 1)
+
+    @classmethod
+    def resume(cls, chain):
+        """
+        チェーン全体を push したのと同じ状態を、末尾のブロックだけから作る
+        各ブロックの difficulty はその時点の bits と一致している前提
+        """
+        tracker = cls()
+        tail = chain[-(RETARGET_INTERVAL + 1):]
+        for block in tail[:-1]:
+            tracker.block_times.append(block.time)
+        tracker.bits = tail[-1].difficulty
+        tracker.push(tail[-1])
+        return tracker
+
+    def push(self, block):
+        self.block_times.append(block.time)
+        if block.index > 0 and block.index % RETARGET_INTERVAL == 0 \
+                and len(self.block_times) == self.block_times.maxlen:
+            self.bits = retarget(self.bits, self.block_times)
+
+#ブロックチェーンクラス
+class Blockchain:
+    def __init__(self):
+        self.chain = []
+        self.current_transactions = []
+        # 残高インデックス: 承認済み残高と未承認の出金額
+        self.balances = defaultdict(float)
+        self.pending_debits = defaultdict(float)
+        # 承認済みの総発行枚数（報酬トランザクションの合計）
+        self.issued = 0
+        # /chain などで返すチェーンのJSON(bytes)。ブロック追加・差し替えで無効化する
+        self._chain_json_cache = None
+        # 次のブロックに求める難易度
+        self.difficulty_tracker = DifficultyTracker()
+        #ジェネシスブロック生成
+        self.new_block(previous_hash='0', proof=0)
+
+    def new_block(self, proof, previous_hash=None):
+        """
+        ブロックチェーンに新しいブロックを作る
+        """
+        # 報酬の計算 (半減期ロジック)
+        reward = self.current_reward()
+
+        # 前のブロックのハッシュを決定
+        if previous_hash:
+            ph = previous_hash
+        elif self.chain:
+            ph = self.chain[-1].hash
+        else:
+            ph = '0'
+
+        block = Block(
+            index=len(self.chain), # 0スタート
+            timestamp=now_us(),
+            transactions=self.current_transactions,
+            proof=proof,
+            previous_hash=ph,
+            reward_at_block=reward,
+            difficulty=self.difficulty,
+        )
+
+        # 自身のハッシュを計算してブロックに含める
+        block.hash = self.hash(block)
+
+        self._apply_transactions(block.transactions)
+        # プールの取引はすべてこのブロックで承認される
+        self.pending_debits.clear()
+
+        self.current_transactions = []
+        self.chain.append(block)
+        self.difficulty_tracker.push(block)
+        self._chain_json_cache = None
+        return block
+
+    def new_transaction(self, sender, recipient, amount, signature=None):
+        """
+        新しいトランザクションをリストに加える
+        """
+        # 同じ公開鍵はブロックをまたいで何度も現れるので intern して1つの文字列を共有する
+        # (残高インデックスの辞書引きも同一オブジェクトなら比較が速い)
+        transaction = Transaction(
+            sender=sys.intern(sender),
+            recipient=sys.intern(recipient),
+            amount=amount,
+            signature=signature,
+            timestamp=now_us(),
+        )
+        self.current_transactions.append(transaction)
+        self.pending_debits[sender] += amount
+        # 次のブロックのインデックスを返す
+        return len(self.chain)
+
+    @staticmethod
+    def hash(block):
+        """
+        ブロックのSHA-256ハッシュを作る ('hash' フィールド自身は含めない)
+        """
+        return hashlib.sha256(block.packed()).hexdigest()
+
+    @property
+    def last_block(self):
+        return self.chain[-1]
+
+    @property
+    def difficulty(self):
+        return self.difficulty_tracker.bits
+
+    def proof_of_work(self, last_proof):
+        """
+        シンプルなPoW: hash(pp')の先頭 difficulty ビットが0となるp'を探す
+        """
+        bits = self.difficulty
+        prefix = f'{last_proof}'.encode()
+        if POW_WORKERS > 1 and bits >= POW_PARALLEL_MIN_BITS:
+            return parallel_find_nonce(prefix, b'', bits)
+
+        start = 0
+        while True:
+            proof = find_nonce(prefix, b'', bits, start, POW_BATCH_SIZE)
+            if proof is not None:
+                return proof
+            start += POW_BATCH_SIZE
+
+    @staticmethod
+    def valid_proof(last_proof, proof, bits=DIFFICULTY_BITS):
+        guess = f'{last_proof}{proof}'.encode()
+        return hashlib.sha256(guess).digest() < POW_TARGETS[bits]
+
+    def valid_chain(self, chain):
+        """
+        チェーンの整合性を確認
+        """
+        # ジェネシスブロックのチェック (簡易)
+        if chain[0].index != 0 or chain[0].previous_hash != '0':
+            return False
+
+        tracker = DifficultyTracker()
+        # 1回の走査で各ブロックを1度ずつ確かめ、おかしな所があればそこで打ち切る
+        for i, block in enumerate(chain):
+            # ブロックの難易度が、それまでのブロック間隔から決まる値と一致するか
+            if block.difficulty != tracker.bits:
+                return False
+            tracker.push(block)
+
+            # ハッシュ値自体が正しいか再計算チェック（改竄検知）
+            if self.hash(block) != block.hash:
+                return False
+
+            if i == 0:
+                continue
+            last_block = chain[i - 1]
+
+            # ブロックの previous_hash が前のブロックの hash と一致するか
+            if block.previous_hash != last_block.hash:
+                return False
+
+            # PoWのチェック
+            if not self.valid_proof(last_block.proof, block.proof, block.difficulty):
+                return False
+
+        return True
+
+    def _apply_transactions(self, transactions):
+        """
+        承認されたトランザクションを残高インデックスに反映する
+        """
+        balances = self.balances
+        for tx in transactions:
+            balances[tx.recipient] += tx.amount
+            balances[tx.sender] -= tx.amount
+            if tx.sender == '0':
+                self.issued += tx.amount
+
+    def replace_chain(self, chain):
+        """
+        チェーンを差し替え、残高インデックスを先頭から作り直す
+        """
+        # 先頭から hash が一致する範囲は共通なので、自分のブロックをそのまま残す
+        fork = 0
+        for ours, theirs in zip(self.chain, chain):
+            if ours.hash != theirs.hash:
+                break
+            fork += 1
+        self.chain = self.chain[:fork] + chain[fork:]
+
+        # 取り消しの引き算は float の誤差が残るので、ブロックを順に足し直して
+        # 最初からこのチェーンを積んだときと同じ値にする
+        self.balances = defaultdict(float)
+        self.issued = 0
+        for block in self.chain:
+            self._apply_transactions(block.transactions)
+
+        self._chain_json_cache = None
+        self.current_transactions = [] # プールをリセット
+        self.pending_debits = defaultdict(float)
+        self.difficulty_tracker = DifficultyTracker.resume(self.chain)
+
+    def chain_json(self):
+        """
+        チェーン全体のJSONを返す。変更がない間は前回の結果を使い回す
+        """
+        if self._chain_json_cache is None:
+            self._chain_json_cache = json_dumps(self.chain)
+        return self._chain_json_cache
+
+    def cached_chain_json(self):
+        """
+        作成済みのチェーンJSONがあれば返す。なければ None (新しくは作らない)
+        """
+        return self._chain_json_cache
+
+    def fill_chain_json(self, chain_json, last_block):
+        """
+        外で組み立てたチェーンJSONをキャッシュに入れる
+        組み立てている間に先頭のブロックが変わっていたら古いので捨てる
+        """
+        if self._chain_json_cache is None and self.chain[-1] is last_block:
+            self._chain_json_cache = chain_json
+
+    def current_reward(self):
+        """
+        承認済みの発行枚数から、次のブロックの報酬を計算する (半減期ロジック)
+        """
+        # n回目の半減は発行量が MAX_COIN_SUPPLY * (1 - 1/2**n) に達したとき
+        # つまり半減回数 n = floor(log2(MAX_COIN_SUPPLY / 残量)) で求まる
+        remaining = MAX_COIN_SUPPLY - self.issued
+        if remaining <= 0:
+            halvings = MAX_HALVINGS
+        else:
+            # 発行量がマイナス (負の報酬トランザクション) だと残量が総量を超えるので 0 で止める
+            halvings = max(0, min(int(MAX_COIN_SUPPLY // remaining).bit_length() - 1, MAX_HALVINGS))
+        return MINING_REWARD_INITIAL / (1 << halvings)
+
+    def calculate_balance(self, address):
+        # 未承認トランザクションの出金も考慮
+        return self.balances.get(address, 0) - self.pending_debits.get(address, 0)
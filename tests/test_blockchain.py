@@ -0,0 +1,210 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app as app_module
+import blockchain_core
+from blockchain_core import RETARGET_INTERVAL, DIFFICULTY_BITS, Block, Blockchain, DifficultyTracker, json_dumps, parse_timestamp
+
+class Clock:
+    """
+    now_us の代わり。呼ばれるたびに step マイクロ秒進む
+    """
+    def __init__(self, step):
+        self.now = 1_700_000_000_000_000
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 1ブロックにつき now_us は2回 (報酬トランザクションとブロック) 呼ばれるので、間隔は40秒
+    # 目標より遅いので難易度は下がっていき、テスト中のマイニングは軽く済む
+    clock = Clock(20_000_000)
+    monkeypatch.setattr(blockchain_core, 'now_us', clock)
+    monkeypatch.setattr(blockchain_core, 'POW_WORKERS', 1)
+    return clock
+
+@pytest.fixture
+def client(monkeypatch):
+    # ノードごとにまっさらなチェーンから始める
+    monkeypatch.setattr(app_module, 'blockchain', Blockchain())
+    return app_module.app.test_client()
+
+def mine(bc, miner, count=1, transactions=()):
+    for _ in range(count):
+        for sender, recipient, amount in transactions:
+            bc.new_transaction(sender, recipient, amount)
+        bc.new_transaction('0', miner, bc.current_reward())
+        bc.new_block(bc.proof_of_work(bc.last_block.proof))
+
+def replay(chain):
+    tracker = DifficultyTracker()
+    for block in chain:
+        tracker.push(block)
+    return tracker
+
+# --- 難易度 ---
+
+def test_difficulty_retargets_from_block_intervals(clock):
+    bc = Blockchain()
+    mine(bc, 'A', RETARGET_INTERVAL * 2)
+    # 間隔が目標の4倍なので、見直しのたびに2ビットずつ (下限まで) 下がる
+    assert bc.chain[RETARGET_INTERVAL].difficulty == DIFFICULTY_BITS
+    assert bc.chain[RETARGET_INTERVAL + 1].difficulty == DIFFICULTY_BITS - 2
+    assert bc.valid_chain(bc.chain)
+
+def test_resume_matches_full_replay_across_retarget(clock):
+    bc = Blockchain()
+    mine(bc, 'A', RETARGET_INTERVAL * 2 + 3)
+    for n in range(1, len(bc.chain) + 1):
+        resumed = DifficultyTracker.resume(bc.chain[:n])
+        replayed = replay(bc.chain[:n])
+        assert resumed.bits == replayed.bits, n
+        assert list(resumed.block_times) == list(replayed.block_times), n
+
+def test_valid_chain_rejects_wrong_difficulty(clock):
+    bc = Blockchain()
+    mine(bc, 'A', 3)
+    bc.chain[2].difficulty += 1
+    assert not bc.valid_chain(bc.chain)
+
+# --- JSON の往復 ---
+
+def js_round_trip(chain):
+    """
+    ブラウザの JSON.parse / JSON.stringify と同じく、整数値の float を int にして返す
+    """
+    def parse_float(text):
+        value = float(text)
+        return int(value) if value.is_integer() else value
+    return json.loads(json_dumps(chain), parse_float=parse_float)
+
+def test_js_round_trip_still_validates(clock):
+    bc = Blockchain()
+    mine(bc, 'A', 2)
+    mine(bc, 'B', 1, [('A', 'B', 10.0)])
+    data = js_round_trip(bc.chain)
+    assert data[1]['transactions'][0]['amount'] == 50
+    assert isinstance(data[1]['transactions'][0]['amount'], int)
+    blocks = [Block.from_dict(b) for b in data]
+    assert [b.hash for b in blocks] == [b.hash for b in bc.chain]
+    assert bc.valid_chain(blocks)
+
+def test_resolve_adopts_js_round_tripped_chain(clock, client):
+    bc = Blockchain()
+    mine(bc, 'A', 3)
+    res = client.post('/nodes/resolve', json={'chain': js_round_trip(bc.chain)})
+    assert res.status_code == 200
+    assert res.get_json()['message'] == 'サーバーのチェーンが更新されました'
+    assert client.post('/balance', json={'address': 'A'}).get_json()['balance'] == 150
+
+# --- /nodes/resolve で不正なチェーンを弾く ---
+
+INVALID_CHAIN_MESSAGE = 'クライアントのチェーンは不正です'
+
+def longer_chain(count=3):
+    bc = Blockchain()
+    mine(bc, 'A', count)
+    return json.loads(json_dumps(bc.chain))
+
+def tamper_amount(chain):
+    chain[1]['transactions'][0]['amount'] = 5000
+
+def tamper_proof(chain):
+    chain[2]['proof'] += 1
+
+def drop_key(chain):
+    del chain[1]['previous_hash']
+
+def wrong_type(chain):
+    chain[1]['transactions'] = 'junk'
+
+def junk_block(chain):
+    chain[2] = 'junk'
+
+def negative_index(chain):
+    chain[1]['index'] = -1
+
+def bad_timestamp(chain):
+    chain[1]['timestamp'] = 'yesterday'
+
+@pytest.mark.parametrize('corrupt', [
+    tamper_amount, tamper_proof, drop_key, wrong_type, junk_block, negative_index, bad_timestamp,
+])
+def test_resolve_rejects_invalid_chain(clock, client, corrupt):
+    chain = longer_chain()
+    corrupt(chain)
+    res = client.post('/nodes/resolve', json={'chain': chain})
+    assert res.status_code == 400
+    assert res.get_json()['message'] == INVALID_CHAIN_MESSAGE
+    assert len(res.get_json()['chain']) == 1
+
+@pytest.mark.parametrize('chain', [{'a': 1, 'b': 2}, 'abc', [1, 2]])
+def test_resolve_rejects_non_chain(clock, client, chain):
+    res = client.post('/nodes/resolve', json={'chain': chain})
+    assert res.status_code == 400
+
+@pytest.mark.parametrize('text', ['9999-12-31T23:59:59+00:00', '0001-01-01T00:00:00+09:00'])
+def test_parse_timestamp_rejects_unwritable_value(text):
+    with pytest.raises(ValueError):
+        parse_timestamp(text)
+
+def test_resolve_rejects_out_of_range_timestamp(clock, client):
+    chain = longer_chain()
+    # ハッシュも付け直し、タイムスタンプ以外は正しいブロックにする
+    tip = Block.from_dict(chain[-1])
+    far = datetime(9999, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+    tip.timestamp = (far - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1)
+    chain[-1]['timestamp'] = '9999-12-31T23:59:59+00:00'
+    chain[-1]['hash'] = Blockchain.hash(tip)
+    res = client.post('/nodes/resolve', json={'chain': chain})
+    assert res.status_code == 400
+    assert res.get_json()['message'] == INVALID_CHAIN_MESSAGE
+    # 採用されていないので /chain はそのまま返せる
+    assert client.get('/chain').status_code == 200
+
+# --- チェーン差し替え後の残高 ---
+
+def test_replace_chain_balances_match_full_rebuild(clock):
+    theirs = Blockchain()
+    mine(theirs, 'M', 1, [('B', 'X', 0.1)])
+    ours = Blockchain()
+    ours.replace_chain(list(theirs.chain))
+    # 1ブロック目までは共通で、その先で分岐する
+    mine(ours, 'M', 1, [('B', 'X', 0.2)])
+    mine(theirs, 'M', 1, [('B', 'X', 0.7)])
+    mine(theirs, 'M', 1, [('B', 'X', 0.3)])
+
+    ours.replace_chain(theirs.chain)
+    # theirs は新しいブロックを順に積んだだけなので、最初から作った値と同じになっている
+    assert ours.balances['X'] == theirs.balances['X'] == 0.1 + 0.7 + 0.3
+    assert dict(ours.balances) == dict(theirs.balances)
+    assert ours.issued == theirs.issued
+    assert ours.calculate_balance('X') == 1.0999999999999999
+
+# --- 入力の型チェック ---
+
+@pytest.mark.parametrize('miner_address', [123, ['A'], {'a': 1}])
+def test_mine_rejects_non_str_miner_address(clock, client, miner_address):
+    res = client.post('/mine', json={'miner_address': miner_address})
+    assert res.status_code == 400
+    assert len(app_module.blockchain.chain) == 1
+
+def test_mine_rewards_miner(clock, client):
+    res = client.post('/mine', json={'miner_address': 'A'})
+    assert res.status_code == 200
+    assert client.post('/balance', json={'address': 'A'}).get_json()['balance'] == 50
+
+@pytest.mark.parametrize('address', [['x'], {'a': 1}, 123, None])
+def test_balance_rejects_non_str_address(client, address):
+    res = client.post('/balance', json={'address': address})
+    assert res.status_code == 400
+
+def test_balance_of_unknown_address_is_zero(client):
+    res = client.post('/balance', json={'address': 'nobody'})
+    assert res.status_code == 200
+    assert res.get_json()['balance'] == 0